@@ -1,43 +1,113 @@
 import os
+import hmac
+import hashlib
+import time
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 from fastapi import Depends, HTTPException, status, Request
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import JWTError, jwt
-from passlib.context import CryptContext
+from jose import JWTError, ExpiredSignatureError, jwk, jwt
+from jose.exceptions import JWKError
+from jose.utils import base64url_decode
+import bcrypt
+import orjson
+from cachetools import TLRUCache
 
 # --- Configuração ---
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = os.getenv("ALGORITHM")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
+# Durações imutáveis, criadas uma única vez
+ACCESS_TOKEN_EXPIRE = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+_DEFAULT_TOKEN_EXPIRE = timedelta(minutes=15)
 
-# Contexto de Senha (usamos bcrypt)
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Chave de verificação construída uma única vez (evita o dispatch do jose por requisição)
+try:
+    _SIGNING_KEY = jwk.construct(SECRET_KEY, ALGORITHM)
+except (JWKError, TypeError, AttributeError) as e:
+    print(f"ALERTA: Não foi possível construir a chave JWT ({e}). Tokens serão rejeitados.")
+    _SIGNING_KEY = None
+
+# Senhas usam o bcrypt nativo direto (sem o dispatch do passlib)
+BCRYPT_ROUNDS = 10
 
 # Define o "esquema" de login
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/v1/auth/token")
 
+# Cache de autenticação: sha256(token) -> (User, exp). Nunca guarda o token
+# em si nem falhas. O TTL curto limita a janela de uma revogação.
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", 5))
+AUTH_CACHE_MAX = int(os.getenv("AUTH_CACHE_MAX", 10_000))
+
+def _auth_cache_ttu(key: bytes, value: tuple, now: float) -> float:
+    """Cada entrada vive AUTH_CACHE_TTL segundos, mas nunca além do 'exp' do token."""
+    return min(now + AUTH_CACHE_TTL, value[1])
+
+_auth_cache = TLRUCache(maxsize=AUTH_CACHE_MAX, ttu=_auth_cache_ttu, timer=time.time)
+
 # --- Funções de Segurança ---
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verifica se a senha em texto plano corresponde ao hash."""
-    return pwd_context.verify(plain_password, hashed_password)
+    try:
+        return bcrypt.checkpw(plain_password.encode(), hashed_password.encode())
+    except ValueError:
+        # Hash malformado
+        return False
 
 def get_password_hash(password: str) -> str:
     """Gera um hash bcrypt da senha."""
-    return pwd_context.hash(password)
+    return bcrypt.hashpw(password.encode(), bcrypt.gensalt(rounds=BCRYPT_ROUNDS)).decode()
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Cria um novo token JWT."""
     to_encode = data.copy()
-    if expires_delta:
-        expire = datetime.now(timezone.utc) + expires_delta
-    else:
-        expire = datetime.now(timezone.utc) + timedelta(minutes=15)
+    expire = datetime.now(timezone.utc) + (expires_delta or _DEFAULT_TOKEN_EXPIRE)
     to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
+def _verify_token(token: str) -> dict:
+    """
+    Verifica a assinatura do JWT com a chave pré-construída e devolve o
+    payload. Equivale ao jwt.decode para os tokens que emitimos (alg fixo,
+    sub/exp obrigatórios, nbf), sem reconstruir chave e algoritmo a cada
+    chamada. É a única decodificação do token: não há parse sem verificação.
+    """
+    if _SIGNING_KEY is None or token.count(".") != 2:
+        raise JWTError("Token inválido.")
+    signing_input, _, signature_b64 = token.rpartition(".")
+    header_b64, _, payload_b64 = signing_input.partition(".")
+    try:
+        header = orjson.loads(base64url_decode(header_b64.encode()))
+        signature = base64url_decode(signature_b64.encode())
+    except (ValueError, TypeError, orjson.JSONDecodeError):
+        raise JWTError("Token malformado.")
+    if not isinstance(header, dict) or header.get("alg") != ALGORITHM:
+        raise JWTError("Algoritmo do token não permitido.")
+    if not _SIGNING_KEY.verify(signing_input.encode(), signature):
+        raise JWTError("Assinatura inválida.")
+    try:
+        payload = orjson.loads(base64url_decode(payload_b64.encode()))
+    except (ValueError, TypeError, orjson.JSONDecodeError):
+        raise JWTError("Payload malformado.")
+    if not isinstance(payload, dict):
+        raise JWTError("Payload malformado.")
+
+    # Claims obrigatórias, checadas no mesmo payload já verificado
+    if "sub" not in payload or "exp" not in payload:
+        raise JWTError("Token sem as claims obrigatórias.")
+    now = time.time()
+    exp = payload["exp"]
+    if not isinstance(exp, (int, float)):
+        raise JWTError("Claim 'exp' inválida.")
+    if exp <= now:
+        raise ExpiredSignatureError("Token expirado.")
+    nbf = payload.get("nbf")
+    if nbf is not None and (not isinstance(nbf, (int, float)) or nbf > now):
+        raise JWTError("Token ainda não é válido.")
+    return payload
+
 # --- Lógica de "Usuário" (simples, baseada no .env) ---
 
 class User:
@@ -52,11 +122,21 @@ APP_USERNAME = os.getenv("APP_USERNAME")
 # como pedido. Não é o ideal, mas cumpre o requisito do .env.
 APP_PASSWORD = os.getenv("APP_PASSWORD")
 
+# Versões em bytes pré-computadas para a comparação em tempo constante
+_APP_USERNAME_BYTES = (APP_USERNAME or "").encode()
+_APP_PASSWORD_BYTES = (APP_PASSWORD or "").encode()
+
 def authenticate_user(username: str, password: str) -> Optional[User]:
     """
     Verifica se o usuário e senha correspondem aos do .env.
+    Usa comparação em tempo constante para não vazar informação por timing.
     """
-    if username == APP_USERNAME and password == APP_PASSWORD:
+    if APP_USERNAME is None or APP_PASSWORD is None:
+        return None
+    # '&' (e não 'and') para sempre comparar os dois campos
+    valid = hmac.compare_digest(username.encode(), _APP_USERNAME_BYTES) & \
+            hmac.compare_digest(password.encode(), _APP_PASSWORD_BYTES)
+    if valid:
         return User(username=username)
     return None
 
@@ -72,12 +152,19 @@ async def get_current_user(token: str = Depends(oauth2_scheme)) -> User:
         detail="Não foi possível validar as credenciais",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    # Sem lock: não há 'await' entre a consulta e a inserção no cache
+    cache_key = hashlib.sha256(token.encode()).digest()
+    cached = _auth_cache.get(cache_key)
+    if cached is not None:
+        return cached[0]
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = _verify_token(token)
         username: str = payload.get("sub")
         if username is None or username != APP_USERNAME:
             raise credentials_exception
-        return User(username=username)
+        user = User(username=username)
+        _auth_cache[cache_key] = (user, payload["exp"])
+        return user
     except JWTError:
         raise credentials_exception
 
@@ -85,6 +172,6 @@ async def get_current_user_ws(token: str) -> User:
     """
     Valida o token JWT recebido (via query param) pelo WebSocket.
     """
-    # Reutiliza a mesma lógica de get_current_user,
-    # mas pega o token de um lugar diferente.
+    # Reutiliza a mesma lógica (e o mesmo cache de tokens) de
+    # get_current_user, mas pega o token de um lugar diferente.
     return await get_current_user(token)
\ No newline at end of file
@@ -1,20 +1,31 @@
 import os
-import json
-import shlex 
+import codecs
+import orjson
+import functools
+import re
+import stat as stat_module
+import secrets
+import threading
+import weakref
+import time
 import asyncio # Importa asyncio para tarefas concorrentes
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 from pathlib import Path
 import aiofiles
 from fastapi import ( 
     FastAPI, HTTPException, WebSocket, 
     WebSocketDisconnect, status, 
-    UploadFile, File, Depends, Query
+    Depends, Query, Request
 )
 from fastapi.responses import FileResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
-from datetime import timedelta
 from pydantic import BaseModel, constr
-from typing import List, Any, Dict
+from python_multipart.multipart import MultipartParser, parse_options_header
+from python_multipart.exceptions import FormParserError
+from types import MappingProxyType
+from typing import List, Any, AsyncIterator, Dict, Iterable, Mapping, Optional
 
 # Importa tudo do nosso novo arquivo auth.py
 from auth import (
@@ -23,7 +34,7 @@ from auth import (
     create_access_token,
     get_current_user,
     get_current_user_ws,
-    ACCESS_TOKEN_EXPIRE_MINUTES
+    ACCESS_TOKEN_EXPIRE
 )
 
 # Importações para Execução Segura
@@ -39,6 +50,13 @@ WORKSPACE_DIR = ARQUIVOS_DIR / "Uploads"
 NOTEBOOK_DIR.mkdir(parents=True, exist_ok=True) 
 WORKSPACE_DIR.mkdir(parents=True, exist_ok=True)
 
+# Caminhos canônicos, resolvidos uma única vez (os diretórios não mudam em execução)
+NOTEBOOK_ROOT = NOTEBOOK_DIR.resolve()
+WORKSPACE_ROOT = WORKSPACE_DIR.resolve()
+
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024 # 8 MiB por leitura no upload
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024 # 1 MiB por bloco no download
+
 HOST_WORKSPACE = os.getenv("HOST_WORKSPACE_PATH")
 if not HOST_WORKSPACE:
     print("ALERTA: HOST_WORKSPACE_PATH não está definido. Montagem de dados pode falhar.")
@@ -46,11 +64,210 @@ if not HOST_WORKSPACE:
 APP_TITLE = os.getenv("APP_TITLE", "Pegasus")
 ENV_MODE = os.getenv("ENV_MODE", "production")
 
+# --- Docker e Ciclo de Vida do App ---
+KERNEL_IMAGE = "python:3.11-slim"
+
+# Um único cliente (e uma única sessão HTTP no docker.sock) para todo o app,
+# mais um pool de threads exclusivo para as chamadas bloqueantes do SDK, para
+# não disputar o pool padrão do loop (usado pelo aiofiles e listagens).
+# Ambos são criados e fechados pelo 'lifespan'.
+DOCKER_THREADS = int(os.getenv("DOCKER_THREADS", 32))
+docker_client: docker.DockerClient = None
+docker_executor: ThreadPoolExecutor = None
+
+async def run_docker(func, *args, **kwargs):
+    """ Executa uma chamada bloqueante do Docker no pool dedicado. """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(docker_executor, functools.partial(func, *args, **kwargs))
+
+_STREAM_END = object()
+# Itens de um stream do Docker que podem esperar na fila por quem consome;
+# cheia, a thread de leitura para de ler e o daemon segura a saída
+DOCKER_STREAM_BACKLOG = 64
+
+async def iterate_docker_stream(stream: Iterable) -> AsyncIterator[list]:
+    """
+    Consome um gerador bloqueante do SDK (exec_start/stats com stream=True)
+    numa thread própria e entrega os itens ao loop por uma fila, para que o
+    'async for' de quem chama nunca trave o loop de eventos. A thread fica
+    fora do docker_executor: um stream pode bloquear por tempo indefinido
+    (stats da sessão inteira, célula sem saída) e não pode esgotar o pool
+    que as chamadas curtas, como a remoção do kernel, precisam.
+    Entrega em lotes: espera o primeiro item e leva junto tudo o que já estiver
+    na fila, para quem consome mandar uma mensagem por lote, e não por item.
+    A fila é limitada: a vaga de um lote só volta quando quem consome pede o
+    próximo, então um cliente lento freia a leitura em vez de acumular memória.
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    slots = threading.Semaphore(DOCKER_STREAM_BACKLOG)
+    stop = threading.Event()
+
+    def wait_slot() -> bool:
+        while not stop.is_set():
+            if slots.acquire(timeout=0.5):
+                return True
+        return False
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            stop.set() # Loop já fechado (desligamento do app)
+
+    def pump():
+        end = _STREAM_END # Um único marcador final: fim normal ou a exceção
+        try:
+            for item in stream:
+                if not wait_slot():
+                    break
+                put(item)
+                if stop.is_set():
+                    break
+        except Exception as e:
+            end = e
+        finally:
+            close = getattr(stream, "close", None)
+            if close:
+                close()
+            put(end)
+
+    threading.Thread(target=pump, name="docker-stream", daemon=True).start()
+    try:
+        while True:
+            batch = [await queue.get()]
+            while not queue.empty():
+                batch.append(queue.get_nowait())
+            last = batch[-1]
+            # O marcador final (fim ou erro) só pode ser o último item da fila
+            if last is _STREAM_END or isinstance(last, Exception):
+                batch.pop()
+            if batch:
+                yield batch
+                slots.release(len(batch))
+            if last is _STREAM_END:
+                return
+            if isinstance(last, Exception):
+                raise last
+    finally:
+        # Cancelado ou encerrado: a thread sai no próximo item do daemon ou
+        # quando o stream fecha (ex: o processo da célula é encerrado)
+        stop.set()
+
+# usuário -> (contêiner, instante da última checagem de estado)
+kernel_sessions: Dict[str, tuple[docker.models.containers.Container, float]] = {}
+# Numa reconexão, o estado do kernel só é reconsultado no daemon após esse intervalo
+KERNEL_RECHECK_SECONDS = 30
+# Um lock por usuário, vivo só enquanto alguma conexão o usa
+kernel_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+kernel_image_task: asyncio.Task = None # Pull da imagem, feito fora do import
+kernel_image_id: Optional[str] = None # ID da imagem, resolvido uma vez no boot
+
+# Kernels já iniciados esperando por uma sessão (evita o cold start no login)
+# Desligado por padrão: cada kernel ocioso reserva memória (e GPU) no host
+KERNEL_POOL_SIZE = int(os.getenv("KERNEL_POOL_SIZE", 0))
+kernel_pool: asyncio.Queue = asyncio.Queue()
+kernel_pool_task: asyncio.Task = None
+kernel_pool_closing = False # Na parada do app, nenhum kernel novo entra no pool
+
+# Todo kernel criado pelo app leva este label, para que sobras de uma parada
+# abrupta (sessões ou pool) possam ser encontradas e removidas no próximo boot.
+# O valor identifica a instalação: outra instância no mesmo daemon (dev ao lado
+# de prod, outro checkout) usa outro valor e seus kernels não são tocados
+KERNEL_LABEL = "pegasus.kernel"
+KERNEL_INSTANCE = os.getenv("PEGASUS_INSTANCE", HOST_WORKSPACE or "default")
+
+async def pull_kernel_image():
+    """
+    Garante a imagem do kernel sem travar o loop de eventos. Se ela já
+    existe localmente, não consulta o registry (boot "quente" instantâneo).
+    """
+    global kernel_image_id
+    try:
+        try:
+            image = await run_docker(docker_client.images.get, KERNEL_IMAGE)
+        except docker.errors.ImageNotFound:
+            print(f"Imagem {KERNEL_IMAGE} não encontrada localmente, baixando...")
+            image = await run_docker(docker_client.images.pull, KERNEL_IMAGE)
+        # Kernels são criados pelo ID: o daemon não resolve a tag a cada criação
+        # e todos os kernels da execução usam exatamente a mesma imagem
+        kernel_image_id = image.id
+        print(f"Imagem {KERNEL_IMAGE} pronta ({image.short_id}).")
+    except Exception as e:
+        print(f"ERRO: Não foi possível baixar a imagem {KERNEL_IMAGE}. {e}")
+
+async def remove_stale_kernels():
+    """ Remove kernels deixados por uma execução anterior desta instância (ex: após um crash). """
+    try:
+        stale = await run_docker(
+            docker_client.api.containers, all=True,
+            filters={"label": f"{KERNEL_LABEL}={KERNEL_INSTANCE}"}
+        )
+    except Exception as e:
+        print(f"Erro ao procurar kernels antigos: {e}")
+        return
+    for info in stale:
+        try:
+            await run_docker(docker_client.api.remove_container, info["Id"], force=True)
+            print(f"Kernel antigo {info['Id'][:12]} removido.")
+        except docker.errors.NotFound:
+            pass
+        except Exception as e:
+            print(f"Erro ao remover kernel antigo {info['Id'][:12]}: {e}")
+
+async def drain_kernel_pool():
+    """ Remove os kernels pré-aquecidos que não chegaram a ser usados. """
+    global kernel_pool_closing
+    kernel_pool_closing = True
+    if kernel_pool_task:
+        # Não cancela: uma criação já em andamento no executor terminaria
+        # mesmo assim, e o kernel ficaria órfão. O reabastecimento para depois
+        # do kernel atual (kernel_pool_closing) e o que ele criou entra no pool.
+        await asyncio.gather(kernel_pool_task, return_exceptions=True)
+    while not kernel_pool.empty():
+        container = kernel_pool.get_nowait()
+        try:
+            await run_docker(container.remove, force=True)
+        except Exception as e:
+            print(f"Erro ao remover kernel pré-aquecido {container.short_id}: {e}")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """ Abre o cliente Docker e o pool de threads na subida e os fecha na parada. """
+    global docker_client, docker_executor, kernel_image_task
+    docker_executor = ThreadPoolExecutor(max_workers=DOCKER_THREADS, thread_name_prefix="docker")
+    try:
+        # Pool de conexões do tamanho do pool de threads: cada thread reaproveita
+        # um socket já aberto (o padrão do SDK é 10; além disso, cada chamada
+        # concorrente abriria e descartaria uma conexão nova no docker.sock)
+        docker_client = await run_docker(docker.from_env, max_pool_size=DOCKER_THREADS)
+        print("Cliente Docker conectado.")
+    except Exception as e:
+        print(f"ERRO: Não foi possível conectar ao Docker. {e}")
+        docker_client = None
+
+    if docker_client:
+        # Antes de o pool começar a criar kernels, para não remover os novos
+        await remove_stale_kernels()
+        kernel_image_task = asyncio.create_task(pull_kernel_image())
+        if HOST_WORKSPACE:
+            schedule_kernel_pool_fill()
+
+    yield
+
+    if kernel_image_task:
+        kernel_image_task.cancel()
+    if docker_client:
+        await drain_kernel_pool()
+        docker_client.close()
+        docker_client = None
+    docker_executor.shutdown(wait=False, cancel_futures=True)
+
 app_config = {"title": APP_TITLE}
 if ENV_MODE == "production":
     app_config["root_path"] = "/api"
 
-app = FastAPI(**app_config)
+app = FastAPI(lifespan=lifespan, **app_config)
 
 origins = [
     "https://pegasus.ovictorfarias.com.br" # Produção
@@ -66,15 +283,116 @@ app.add_middleware(
     allow_headers=["*"], 
 )
 
-try:
-    docker_client = docker.from_env()
-    docker_client.images.pull("python:3.11-slim")
-    print("Cliente Docker conectado e imagem python:3.11-slim pronta.")
-except Exception as e:
-    print(f"ERRO: Não foi possível conectar ao Docker. {e}")
-    docker_client = None
+# Mensagens fixas do WebSocket, serializadas uma única vez (enviadas como texto)
+FS_UPDATE_MESSAGE = orjson.dumps({
+    "type": "filesystem_update",
+    "content": "Verificando arquivos..."
+}).decode()
+NO_DOCKER_MESSAGE = orjson.dumps({
+    "type": "stderr",
+    "content": "Erro Crítico: O servidor não está conectado ao Docker."
+}).decode()
+NO_HOST_WORKSPACE_MESSAGE = orjson.dumps({
+    "type": "stderr",
+    "content": "Erro Crítico: O servidor não está configurado com HOST_WORKSPACE_PATH."
+}).decode()
+
+# Mensagens 'stream' que podem esperar envio num WebSocket antes de a célula ser freada
+WS_STREAM_BACKLOG = 256
+
+class WebSocketWriter:
+    """
+    Único escritor de um WebSocket. As tarefas da sessão (execução, stats,
+    loop principal) só enfileiram; uma tarefa em segundo plano serializa com
+    orjson e envia. Mensagens 'stream' seguidas (do mesmo fluxo) viram um único frame.
+    Cada frame continua sendo um objeto em texto: o frontend faz JSON.parse(event.data).
+    A saída das células entra por send_stream, que espera quando há
+    WS_STREAM_BACKLOG mensagens pendentes: um cliente lento freia a célula
+    (e, pela fila do stream, a leitura do Docker) em vez de acumular memória.
+    """
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.stream_slots = asyncio.Semaphore(WS_STREAM_BACKLOG)
+        self.closed = False
+        self.task = asyncio.create_task(self._run())
+
+    def send(self, message: Dict[str, Any]):
+        """ Mensagens de controle (poucas e pequenas): nunca esperam. """
+        if not self.closed:
+            self.queue.put_nowait(message)
+
+    async def send_stream(self, name: str, content: str):
+        await self.stream_slots.acquire()
+        if self.closed:
+            self.stream_slots.release()
+            return
+        self.queue.put_nowait({"type": "stream", "name": name, "content": content})
+
+    def send_text(self, text: str):
+        """ Para mensagens já serializadas (ex: FS_UPDATE_MESSAGE). """
+        if not self.closed:
+            self.queue.put_nowait(text)
+
+    async def flush(self):
+        """ Espera tudo o que já foi enfileirado ser enviado (ou descartado). """
+        await self.queue.join()
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+
+    def _done(self, message):
+        if isinstance(message, dict) and message.get("type") == "stream":
+            self.stream_slots.release()
+        self.queue.task_done()
+
+    @staticmethod
+    def _frames(batch: list) -> List[str]:
+        frames = []
+        # Mensagem 'stream' acumulada: (fluxo, pedaços), unidos uma única vez
+        pending_stream = None
+
+        def flush_stream():
+            name, parts = pending_stream
+            frames.append(orjson.dumps({"type": "stream", "name": name, "content": "".join(parts)}).decode())
+
+        for message in batch:
+            if isinstance(message, dict) and message.get("type") == "stream":
+                if pending_stream and pending_stream[0] == message.get("name"):
+                    pending_stream[1].append(message["content"])
+                    continue
+                if pending_stream:
+                    flush_stream()
+                pending_stream = (message.get("name"), [message["content"]])
+                continue
+            if pending_stream:
+                flush_stream()
+                pending_stream = None
+            frames.append(message if isinstance(message, str) else orjson.dumps(message).decode())
+        if pending_stream:
+            flush_stream()
+        return frames
 
-kernel_sessions: Dict[str, docker.models.containers.Container] = {}
+    async def _run(self):
+        try:
+            while True:
+                batch = [await self.queue.get()]
+                while not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                try:
+                    for frame in self._frames(batch):
+                        await self.websocket.send_text(frame)
+                finally:
+                    for message in batch:
+                        self._done(message)
+        except Exception as e:
+            # Socket fechado: o loop principal trata a desconexão; aqui só se
+            # descarta o que ainda viria, para ninguém esperar num flush
+            print(f"Envio pelo WebSocket interrompido: {e}")
+            self.closed = True
+            while not self.queue.empty():
+                self._done(self.queue.get_nowait())
 
 # --- Modelos de Dados (Pydantic) ---
 class StatusResponse(BaseModel):
@@ -100,73 +418,445 @@ class RenameRequest(BaseModel):
         min_length = 1
 
 # --- Funções de Ajuda (Segurança) ---
-def get_safe_path(filename: str) -> Path:
-    if ".." in filename or "/" in filename or "\\" in filename:
+
+# '..', '/' ou '\\' em uma única varredura
+UNSAFE_FILENAME = re.compile(r"\.\.|[/\\]")
+
+@functools.lru_cache(maxsize=2048)
+def _safe_under(root: Path, filename: str, suffix: Optional[str] = None) -> Optional[Path]:
+    """
+    Parte pura (sem syscalls) de get_safe_path/get_safe_workspace_path,
+    memoizada por (raiz, nome, sufixo).
+    """
+    if suffix and not filename.endswith(suffix):
+        filename += suffix
+    # O nome já é um único componente: basta juntá-lo ao diretório, sem resolve().
+    # Comparar só o pai direto é O(1) e, ao contrário de is_relative_to, recusa
+    # nomes que caem na própria raiz (ex.: "." ou "").
+    safe_path = root / filename
+    return safe_path if safe_path.parent == root else None
+
+def _checked_path(root: Path, filename: str, suffix: Optional[str], denied_detail: str) -> Path:
+    if UNSAFE_FILENAME.search(filename):
         raise HTTPException(status_code=400, detail="Nome de arquivo inválido.")
-    if not filename.endswith(".ipynb"):
-         filename += ".ipynb"
-    safe_path = (NOTEBOOK_DIR / filename).resolve()
-    if NOTEBOOK_DIR.resolve() not in safe_path.parents:
-        raise HTTPException(status_code=403, detail="Acesso negado.")
+    # O lstat (symlink) fica fora do cache: depende do estado do disco
+    safe_path = _safe_under(root, filename, suffix)
+    if safe_path is None or safe_path.is_symlink():
+        raise HTTPException(status_code=403, detail=denied_detail)
     return safe_path
 
+def get_safe_path(filename: str) -> Path:
+    return _checked_path(NOTEBOOK_ROOT, filename, ".ipynb", "Acesso negado.")
+
 def get_safe_workspace_path(filename: str) -> Path:
-    if ".." in filename or "/" in filename or "\\" in filename:
-        raise HTTPException(status_code=400, detail="Nome de arquivo inválido.")
-    safe_path = (WORKSPACE_DIR / filename).resolve()
-    if WORKSPACE_DIR.resolve() not in safe_path.parents:
-        raise HTTPException(status_code=403, detail="Acesso negado ao workspace.")
-    return safe_path
+    return _checked_path(WORKSPACE_ROOT, filename, None, "Acesso negado ao workspace.")
+
+def is_valid_notebook(data: Any) -> bool:
+    """ Validação estrutural mínima de um .ipynb (mesmos campos de NotebookContent). """
+    return (
+        isinstance(data, dict)
+        and isinstance(data.get("cells"), list)
+        and all(isinstance(cell, dict) for cell in data["cells"])
+        and isinstance(data.get("metadata"), dict)
+        and isinstance(data.get("nbformat"), int)
+        and isinstance(data.get("nbformat_minor"), int)
+    )
+
+# --- Funções de Ajuda (Arquivos) ---
+
+class LargeChunkFileResponse(FileResponse):
+    """ FileResponse com blocos maiores (o padrão do Starlette é 64 KiB). """
+    chunk_size = DOWNLOAD_CHUNK_SIZE
+
+def get_file_etag(st: os.stat_result) -> str:
+    """
+    ETag derivada só do stat (inode, mtime em ns, tamanho): barata de montar,
+    sem cache nem hash, e muda sempre que o arquivo é regravado ou substituído.
+    """
+    return f'"{st.st_ino:x}-{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """ Verifica o cabeçalho If-None-Match enviado pelo navegador. """
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+def file_download_response(
+    request: Request, 
+    safe_path: Path, 
+    filename: str, 
+    media_type: str, 
+    not_found_detail: str
+) -> Response:
+    """
+    Monta a resposta de download com ETag. Se o navegador já tem a versão
+    atual (If-None-Match), responde 304 sem abrir o arquivo.
+    """
+    try:
+        st = safe_path.stat()
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail=not_found_detail)
+    if not stat_module.S_ISREG(st.st_mode):
+        raise HTTPException(status_code=404, detail=not_found_detail)
+
+    etag = get_file_etag(st)
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=0, must-revalidate"}
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    # stat_result evita que o FileResponse refaça o stat do arquivo
+    return LargeChunkFileResponse(
+        path=safe_path, filename=filename, media_type=media_type, headers=headers, stat_result=st
+    )
+
+# Nome dos temporários: ".{nome}.{8 hex}.tmp". A listagem do workspace
+# esconde só o que casa com este formato exato
+TEMP_TOKEN_BYTES = 4
+TEMP_FILENAME = re.compile(rf"^\..+\.[0-9a-f]{{{TEMP_TOKEN_BYTES * 2}}}\.tmp$")
+
+def temp_path_for(path: Path) -> Path:
+    """ Temporário oculto e único no mesmo diretório (os.replace não cruza sistemas de arquivos). """
+    return path.with_name(f".{path.name}.{secrets.token_hex(TEMP_TOKEN_BYTES)}.tmp")
+
+def write_file_atomic(path: Path, data: bytes, fsync: bool = False) -> None:
+    """
+    Grava num temporário do mesmo diretório e troca com os.replace (atômico no
+    POSIX): uma queda no meio não trunca o arquivo e leitores nunca veem um JSON
+    pela metade. O fsync (arquivo e diretório) só é pago se pedido.
+    """
+    tmp_path = temp_path_for(path)
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    if fsync:
+        dir_fd = os.open(path.parent, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+# Listagens rodam numa thread: em diretórios grandes não travam o loop de eventos.
+# os.scandir reaproveita o tipo vindo da própria leitura do diretório; symlinks
+# ficam de fora (sem stat extra), já que get_safe_*_path também os recusa.
+def scan_notebooks() -> List[NotebookInfo]:
+    with os.scandir(NOTEBOOK_DIR) as entries:
+        return [
+            NotebookInfo(filename=entry.name)
+            for entry in entries
+            if entry.name.endswith(".ipynb") and entry.is_file(follow_symlinks=False)
+        ]
+
+def scan_workspace() -> List[FileInfo]:
+    with os.scandir(WORKSPACE_DIR) as entries:
+        return [
+            FileInfo(filename=entry.name, size_kb=round(entry.stat(follow_symlinks=False).st_size / 1024, 2))
+            for entry in entries
+            if entry.is_file(follow_symlinks=False)
+            # Temporários de uploads/gravações em andamento (ver temp_path_for)
+            and not TEMP_FILENAME.match(entry.name)
+        ]
+
+class StreamingUploadParser:
+    """
+    Parser de multipart/form-data alimentado direto pelo stream da requisição.
+    Os callbacks (síncronos) do python-multipart só acumulam eventos; quem
+    grava no disco é o endpoint, com await, entre um pedaço e outro.
+    """
+    def __init__(self, boundary: bytes):
+        self.events: List[tuple[str, Any]] = []
+        self._header_field = b""
+        self._header_value = b""
+        self._disposition = b""
+        self.parser = MultipartParser(boundary, {
+            "on_part_begin": self.on_part_begin,
+            "on_header_field": self.on_header_field,
+            "on_header_value": self.on_header_value,
+            "on_header_end": self.on_header_end,
+            "on_headers_finished": self.on_headers_finished,
+            "on_part_data": self.on_part_data,
+            "on_part_end": self.on_part_end,
+        })
+
+    def on_part_begin(self):
+        self._disposition = b""
+
+    def on_header_field(self, data: bytes, start: int, end: int):
+        self._header_field += data[start:end]
+
+    def on_header_value(self, data: bytes, start: int, end: int):
+        self._header_value += data[start:end]
+
+    def on_header_end(self):
+        if self._header_field.lower() == b"content-disposition":
+            self._disposition = self._header_value
+        self._header_field = b""
+        self._header_value = b""
+
+    def on_headers_finished(self):
+        _, options = parse_options_header(self._disposition)
+        name = options.get(b"name", b"").decode("latin-1")
+        filename = options.get(b"filename")
+        if filename is not None:
+            try:
+                filename = filename.decode("utf-8")
+            except UnicodeDecodeError:
+                filename = filename.decode("latin-1")
+        self.events.append(("begin", (name, filename)))
+
+    def on_part_data(self, data: bytes, start: int, end: int):
+        self.events.append(("data", data[start:end]))
+
+    def on_part_end(self):
+        self.events.append(("end", None))
+
+    def feed(self, chunk: bytes) -> List[tuple[str, Any]]:
+        """ Processa um pedaço do corpo e devolve os eventos gerados por ele. """
+        self.parser.write(chunk)
+        events, self.events = self.events, []
+        return events
+
+    def finalize(self):
+        self.parser.finalize()
+
+# --- Funções Helper do Docker ---
+
+# Configurações do kernel montadas uma única vez (HOST_WORKSPACE é fixo em
+# execução); imutáveis, para nenhuma criação alterar o molde das seguintes.
+def _kernel_mounts() -> tuple[Dict[str, Dict[str, str]], str]:
+    if not HOST_WORKSPACE:
+        return {}, "/"
+    host_path_str = str(HOST_WORKSPACE).replace("\\", "/")
+    if host_path_str.startswith("C:"):
+        host_path_str = "/" + host_path_str[0].lower() + host_path_str[2:]
+    return {host_path_str: {'bind': '/data', 'mode': 'rw'}}, "/data/Uploads"
+
+_KERNEL_VOLUMES, _KERNEL_WORKDIR = _kernel_mounts()
+
+KERNEL_CONTAINER_CONFIG = MappingProxyType({
+    "labels": {KERNEL_LABEL: KERNEL_INSTANCE},
+    "command": ["sleep", "infinity"], 
+    "detach": True, 
+    "working_dir": _KERNEL_WORKDIR,
+})
+KERNEL_HOST_CONFIG = MappingProxyType({
+    "mem_limit": "12g", # Limite de 12GB de RAM
+    "binds": _KERNEL_VOLUMES,
+    "auto_remove": True,
+})
+KERNEL_GPU_HOST_CONFIG = MappingProxyType({
+    **KERNEL_HOST_CONFIG,
+    "device_requests": [
+        DeviceRequest(count=-1, capabilities=[['gpu']])
+    ]
+})
+
+def start_kernel_container(
+    container_config: Mapping[str, Any], 
+    host_config: Mapping[str, Any]
+) -> docker.models.containers.Container:
+    """
+    Cria e inicia o contêiner do kernel pela API de baixo nível (create + start),
+    evitando o inspect extra que o containers.run faz a cada criação.
+    """
+    api = docker_client.api
+    container_id = api.create_container(
+        image=kernel_image_id or KERNEL_IMAGE,
+        host_config=api.create_host_config(**host_config),
+        **container_config
+    )["Id"]
+    try:
+        api.start(container_id)
+    except docker.errors.APIError:
+        # O contêiner foi criado mas não subiu (ex: GPU indisponível)
+        api.remove_container(container_id, force=True)
+        raise
+    return docker_client.containers.prepare_model({"Id": container_id})
+
+def create_kernel_container() -> docker.models.containers.Container:
+    """ Cria um novo kernel, tentando GPU primeiro e caindo para CPU. """
+    try:
+        # TENTATIVA 1: Alocar com GPU
+        print("Tentando alocar kernel com GPU...")
+        container = start_kernel_container(KERNEL_CONTAINER_CONFIG, KERNEL_GPU_HOST_CONFIG)
+        print(f"Kernel {container.short_id} criado com SUCESSO (com GPU).")
+    except docker.errors.APIError as e:
+        if "could not select device driver" in str(e):
+            # TENTATIVA 2: Alocar com CPU Apenas
+            print(f"Falha ao alocar GPU (NVIDIA Toolkit ausente?). Erro: {e}")
+            print("Tentando alocar kernel em modo fallback (somente CPU)...")
+            container = start_kernel_container(KERNEL_CONTAINER_CONFIG, KERNEL_HOST_CONFIG)
+            print(f"Kernel {container.short_id} criado com SUCESSO (somente CPU).")
+        else:
+            raise e
+    return container
+
+# --- Pool de Kernels Pré-aquecidos ---
+
+async def fill_kernel_pool():
+    """ Sobe kernels em segundo plano até o pool ter KERNEL_POOL_SIZE prontos. """
+    if kernel_image_task:
+        await kernel_image_task
+    while not kernel_pool_closing and kernel_pool.qsize() < KERNEL_POOL_SIZE:
+        try:
+            container = await run_docker(create_kernel_container)
+        except Exception as e:
+            print(f"Erro ao pré-aquecer kernel: {e}")
+            return
+        kernel_pool.put_nowait(container)
+
+def schedule_kernel_pool_fill():
+    global kernel_pool_task
+    if KERNEL_POOL_SIZE > 0 and not kernel_pool_closing and (kernel_pool_task is None or kernel_pool_task.done()):
+        kernel_pool_task = asyncio.create_task(fill_kernel_pool())
+
+async def acquire_kernel() -> docker.models.containers.Container:
+    """
+    Entrega um kernel para uma nova sessão: usa um pré-aquecido do pool se
+    houver (sem pagar o tempo de criação) ou cria um na hora. O pool é
+    reabastecido em segundo plano; cada kernel continua exclusivo da sessão.
+    """
+    try:
+        while not kernel_pool.empty():
+            container = kernel_pool.get_nowait()
+            try:
+                await run_docker(container.reload)
+                if container.status == "running":
+                    print(f"Usando kernel pré-aquecido {container.short_id}.")
+                    return container
+            except docker.errors.NotFound:
+                pass
+            print(f"Kernel pré-aquecido {container.short_id} não está mais ativo, descartando.")
+
+        # Garante que o pull inicial da imagem terminou
+        if kernel_image_task:
+            await kernel_image_task
+        return await run_docker(create_kernel_container)
+    finally:
+        schedule_kernel_pool_fill()
 
 # --- Funções Helper de Stats (Sprint 14) ---
 
+STATS_INTERVAL = 2.0 # Segundos mínimos entre duas mensagens de stats ao frontend
+
+# cgroup v2 do host: quando o backend enxerga os cgroups dos kernels (roda no
+# host ou com /sys/fs/cgroup montado), os stats saem direto do sysfs, sem
+# passar pelo daemon nem decodificar o JSON do stream de stats.
+CGROUP_ROOT = Path(os.getenv("CGROUP_ROOT", "/sys/fs/cgroup"))
+HOST_MEMORY = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+def find_kernel_cgroup(container_id: str) -> Optional[Path]:
+    """ Diretório cgroup v2 do contêiner (driver systemd ou cgroupfs), se visível. """
+    for relative in (f"system.slice/docker-{container_id}.scope", f"docker/{container_id}"):
+        cgroup_path = CGROUP_ROOT / relative
+        if (cgroup_path / "cpu.stat").is_file():
+            return cgroup_path
+    return None
+
+def read_cgroup_stats(cgroup_path: Path) -> tuple[int, int, int]:
+    """ Lê (uso de CPU em µs, memória atual, limite de memória) do cgroup. """
+    usage_usec = 0
+    for line in (cgroup_path / "cpu.stat").read_text().splitlines():
+        key, _, value = line.partition(" ")
+        if key == "usage_usec":
+            usage_usec = int(value)
+            break
+    ram_usage = int((cgroup_path / "memory.current").read_text())
+    ram_max = (cgroup_path / "memory.max").read_text().strip()
+    ram_limit = HOST_MEMORY if ram_max == "max" else int(ram_max)
+    return usage_usec, ram_usage, ram_limit
+
+async def stream_cgroup_stats(writer: WebSocketWriter, cgroup_path: Path):
+    """ Amostra o cgroup a cada STATS_INTERVAL; CPU% é o delta de uso sobre o tempo real. """
+    prev_usage, _, _ = await asyncio.to_thread(read_cgroup_stats, cgroup_path)
+    prev_time = time.monotonic()
+    while True:
+        await asyncio.sleep(STATS_INTERVAL)
+        usage_usec, ram_usage, ram_limit = await asyncio.to_thread(read_cgroup_stats, cgroup_path)
+        now = time.monotonic()
+        # Mesma escala do Docker: 100% equivale a uma CPU inteira
+        cpu_percent = max(usage_usec - prev_usage, 0) / ((now - prev_time) * 1e6) * 100.0
+        prev_usage, prev_time = usage_usec, now
+        writer.send({
+            "type": "resource_stats",
+            "content": {
+                "ram_usage": ram_usage,
+                "ram_limit": ram_limit,
+                "cpu_percent": round(cpu_percent, 2)
+            }
+        })
+
+async def stream_docker_stats(
+    writer: WebSocketWriter, 
+    container: docker.models.containers.Container
+):
+    """ Fallback: consome o stream de stats do daemon. """
+    stats_stream = await run_docker(
+        docker_client.api.stats,
+        container.id, 
+        stream=True, 
+        decode=True
+    )
+    
+    # Um único stream aberto por toda a sessão: o daemon empurra ~1 amostra/s
+    # e aqui só se descartam as que chegam antes de STATS_INTERVAL
+    last_emit = float("-inf")
+    async for batch in iterate_docker_stream(stats_stream):
+        if time.monotonic() - last_emit < STATS_INTERVAL:
+            continue
+        stats = batch[-1] # Só a amostra mais recente de cada lote interessa
+        try:
+            mem_stats = stats.get('memory_stats', {})
+            ram_usage = mem_stats.get('usage', 0)
+            ram_limit = mem_stats.get('limit', 0)
+
+            cpu_delta = stats['cpu_stats']['cpu_usage']['total_usage'] - \
+                        stats['precpu_stats']['cpu_usage']['total_usage']
+            system_delta = stats['cpu_stats']['system_cpu_usage'] - \
+                           stats['precpu_stats']['system_cpu_usage']
+            
+            if 'online_cpus' in stats['cpu_stats']:
+                cpu_count = stats['cpu_stats']['online_cpus']
+            else:
+                cpu_count = len(stats['cpu_stats']['cpu_usage']['percpu_usage'])
+
+            cpu_percent = 0.0
+            if system_delta > 0.0 and cpu_delta > 0.0:
+                cpu_percent = (cpu_delta / system_delta) * cpu_count * 100.0
+            
+            writer.send({
+                "type": "resource_stats",
+                "content": {
+                    "ram_usage": ram_usage,
+                    "ram_limit": ram_limit,
+                    "cpu_percent": round(cpu_percent, 2)
+                }
+            })
+            last_emit = time.monotonic()
+        except (KeyError, ZeroDivisionError, TypeError) as e:
+            print(f"Aviso de stats (ignorável): {e}")
+            pass
+
 async def stream_resource_stats(
-    websocket: WebSocket, 
+    writer: WebSocketWriter, 
     container: docker.models.containers.Container
 ):
     """ Tarefa concorrente que transmite estatísticas (RAM/CPU) """
     try:
-        stats_stream = docker_client.api.stats(
-            container.id, 
-            stream=True, 
-            decode=True
-        )
-        
-        print(f"Iniciando streaming de stats para o kernel {container.short_id}...")
-        
-        for stats in stats_stream:
-            try:
-                mem_stats = stats.get('memory_stats', {})
-                ram_usage = mem_stats.get('usage', 0)
-                ram_limit = mem_stats.get('limit', 0)
-
-                cpu_delta = stats['cpu_stats']['cpu_usage']['total_usage'] - \
-                            stats['precpu_stats']['cpu_usage']['total_usage']
-                system_delta = stats['cpu_stats']['system_cpu_usage'] - \
-                               stats['precpu_stats']['system_cpu_usage']
-                
-                if 'online_cpus' in stats['cpu_stats']:
-                    cpu_count = stats['cpu_stats']['online_cpus']
-                else:
-                    cpu_count = len(stats['cpu_stats']['cpu_usage']['percpu_usage'])
-
-                cpu_percent = 0.0
-                if system_delta > 0.0 and cpu_delta > 0.0:
-                    cpu_percent = (cpu_delta / system_delta) * cpu_count * 100.0
-                
-                await websocket.send_json({
-                    "type": "resource_stats",
-                    "content": {
-                        "ram_usage": ram_usage,
-                        "ram_limit": ram_limit,
-                        "cpu_percent": round(cpu_percent, 2)
-                    }
-                })
-            except (KeyError, ZeroDivisionError, TypeError) as e:
-                print(f"Aviso de stats (ignorável): {e}")
-                pass
-            
-            await asyncio.sleep(2)
+        cgroup_path = await asyncio.to_thread(find_kernel_cgroup, container.id)
+        if cgroup_path:
+            print(f"Iniciando stats via cgroup para o kernel {container.short_id}...")
+            await stream_cgroup_stats(writer, cgroup_path)
+        else:
+            print(f"Iniciando streaming de stats para o kernel {container.short_id}...")
+            await stream_docker_stats(writer, container)
             
     except asyncio.CancelledError:
         print(f"Parando streaming de stats para o kernel {container.short_id}.")
@@ -174,47 +864,59 @@ async def stream_resource_stats(
     except Exception as e:
         print(f"Erro no streaming de stats: {e}")
         try:
-            await websocket.send_json({
+            writer.send({
                 "type": "stderr", 
                 "content": f"Monitoramento de recursos falhou: {e}"
             })
         except:
             pass # Socket pode estar morto
 
-async def get_disk_stats(
-    websocket: WebSocket, 
-    container: docker.models.containers.Container
-):
-    """ Executa 'df' UMA VEZ e envia as estatísticas de disco. """
+async def get_disk_stats(writer: WebSocketWriter):
+    """
+    Envia as estatísticas de disco UMA VEZ. O /data do kernel é o mesmo
+    diretório do host montado aqui em ARQUIVOS_DIR, então um statvfs local
+    equivale ao 'df' dentro do contêiner, sem um docker exec por sessão.
+    """
     try:
-        cmd = ["df", "-Pk", "/data"]
-        exec_instance = docker_client.api.exec_create(container.id, cmd=cmd, tty=False)
-        exec_output_raw = docker_client.api.exec_start(exec_instance['Id'], tty=False, demux=True)
-        
-        # exec_start pode retornar None se não houver saída
-        if exec_output_raw[0]:
-            stdout = exec_output_raw[0].decode('utf-8').strip()
-            lines = stdout.splitlines()
-            if len(lines) > 1:
-                parts = lines[1].split()
-                if len(parts) >= 4:
-                    disk_limit_kb = int(parts[1])
-                    disk_usage_kb = int(parts[2])
-                    
-                    await websocket.send_json({
-                        "type": "disk_stats",
-                        "content": {
-                            "disk_usage": disk_usage_kb * 1024, # Converte para bytes
-                            "disk_limit": disk_limit_kb * 1024  # Converte para bytes
-                        }
-                    })
-    except Exception as e:
+        fs = await asyncio.to_thread(os.statvfs, ARQUIVOS_DIR)
+    except OSError as e:
         print(f"Erro ao obter stats de disco: {e}")
-        pass
+        return
+    writer.send({
+        "type": "disk_stats",
+        "content": {
+            "disk_usage": (fs.f_blocks - fs.f_bfree) * fs.f_frsize, # Em bytes, como o 'Used' do df
+            "disk_limit": fs.f_blocks * fs.f_frsize
+        }
+    })
 
 # --- Função Helper de Execução ---
+
+# Primeiro caractere não-branco de uma linha que não é comentário
+FIRST_NONTRIVIAL_CHAR = re.compile(r"(?m)^[ \t]*(?!#)(\S)")
+
+# Ambiente das execuções. Sem TTY, o Python bufferiza a saída: PYTHONUNBUFFERED
+# mantém o streaming também para scripts chamados de células shell (!python ...)
+PYTHON_EXEC_ENV = {"PYTHONUNBUFFERED": "1"}
+SHELL_EXEC_ENV = {**PYTHON_EXEC_ENV, "DEBIAN_FRONTEND": "noninteractive"}
+
+# Cada execução leva um marcador único no ambiente, herdado pelos subprocessos:
+# "Parar" encontra por ele todos os processos da célula dentro do contêiner
+EXEC_MARKER_VAR = "PEGASUS_EXEC"
+KILL_EXEC_SCRIPT = (
+    'for p in /proc/[0-9]*; do '
+    'grep -qxzF "$1" "$p/environ" 2>/dev/null && kill -KILL "${p#/proc/}"; '
+    'done'
+)
+
+async def kill_exec(container: docker.models.containers.Container, marker: str):
+    """ Encerra os processos de uma execução (a API de exec não tem 'kill'). """
+    kill_cmd = ["/bin/sh", "-c", KILL_EXEC_SCRIPT, "sh", f"{EXEC_MARKER_VAR}={marker}"]
+    exec_instance = await run_docker(docker_client.api.exec_create, container.id, cmd=kill_cmd)
+    await run_docker(docker_client.api.exec_start, exec_instance["Id"])
+
 async def run_cell_execution(
-    websocket: WebSocket, 
+    writer: WebSocketWriter, 
     container: docker.models.containers.Container, 
     code: str
 ):
@@ -222,75 +924,95 @@ async def run_cell_execution(
     Executa o código da célula como uma tarefa separada,
     permitindo que a conexão principal do WebSocket continue ouvindo.
     """
+    marker = secrets.token_hex(8)
+    start_future: Optional[asyncio.Future] = None
+    output_stream = None
+    streaming = False # A partir daqui, quem fecha o stream é iterate_docker_stream
     try:
         # Prepara o comando (Shell ou Python)
         command_to_run = []
+        environment = PYTHON_EXEC_ENV
         code_to_run = code.strip()
-        cell_type = "python"
-        
-        for line in code_to_run.splitlines():
-            stripped_line = line.strip()
-            if not stripped_line: continue
-            if stripped_line.startswith("#"): continue
-            if stripped_line.startswith("!"):
-                cell_type = "shell"
-            break 
+        # O tipo vem do primeiro caractere útil (fora linhas vazias e comentários)
+        first_char = FIRST_NONTRIVIAL_CHAR.search(code_to_run)
+        cell_type = "shell" if first_char and first_char.group(1) == "!" else "python"
         
         if cell_type == "shell":
-            shell_commands = []
-            for line in code_to_run.splitlines():
-                stripped_line = line.strip()
-                if stripped_line.startswith("!"):
-                    shell_commands.append(stripped_line[1:].strip())
+            shell_commands = [
+                stripped_line[1:].strip()
+                for stripped_line in map(str.strip, code_to_run.splitlines())
+                if stripped_line.startswith("!")
+            ]
             
             full_shell_command = " && ".join(shell_commands)
-            final_command_string = f"export DEBIAN_FRONTEND=noninteractive && {full_shell_command}"
-            command_to_run = ["/bin/sh", "-c", final_command_string]
+            command_to_run = ["/bin/sh", "-c", full_shell_command]
+            # Injetado pelo próprio Docker, sem um 'export' no comando
+            environment = SHELL_EXEC_ENV
         else:
-            safe_code = shlex.quote(code_to_run)
-            command_to_run = ["/bin/sh", "-c", f"python -c {safe_code}"]
+            # A API de exec recebe argv como lista: o código vai direto para o
+            # python, sem shell intermediário nem escape com shlex
+            command_to_run = ["python", "-u", "-c", code_to_run]
         
         # --- Lógica de Execução com STREAMING ---
         
-        # 1. Criar a instância de execução
-        exec_instance = docker_client.api.exec_create(
+        # 1. Criar a instância de execução (sem TTY: stdout e stderr separados)
+        exec_instance = await run_docker(
+            docker_client.api.exec_create,
             container=container.id, 
             cmd=command_to_run,
-            tty=True,
+            environment={**environment, EXEC_MARKER_VAR: marker},
+            tty=False,
             stdout=True,
             stderr=True
         )
         exec_id = exec_instance.get('Id')
 
-        # 2. Iniciar a execução e obter o fluxo (stream)
-        output_stream = docker_client.api.exec_start(
+        # 2. Iniciar a execução e obter o fluxo (stream). Protegido com shield:
+        # cancelada no meio, a chamada segue na thread e o processo nasce mesmo
+        # assim, então o 'Parar' precisa esperá-la antes de procurar o processo
+        start_future = asyncio.ensure_future(run_docker(
+            docker_client.api.exec_start,
             exec_id=exec_id, 
             stream=True,
-            demux=False, 
-            tty=True
-        )
+            demux=True, 
+            tty=False
+        ))
+        output_stream = await asyncio.shield(start_future)
         
         # 3. Iterar sobre o fluxo de saída em tempo real
-        for chunk in output_stream:
-            output_line = chunk.decode('utf-8')
-            await websocket.send_json({
-                "type": "stream",
-                "content": output_line
-            })
-            await asyncio.sleep(0.001) # Libera o loop de eventos
+        # Decodificadores incrementais: um caractere UTF-8 pode vir partido entre dois pedaços
+        decoders = {
+            "stdout": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+            "stderr": codecs.getincrementaldecoder("utf-8")(errors="replace"),
+        }
+        streaming = True
+        async for batch in iterate_docker_stream(output_stream):
+            # Cada item é (stdout, stderr), com um dos dois None. Pedaços seguidos
+            # do mesmo fluxo vão num único frame, preservando a ordem entre eles.
+            pieces = []
+            for stdout_chunk, stderr_chunk in batch:
+                name, data = ("stdout", stdout_chunk) if stdout_chunk is not None else ("stderr", stderr_chunk)
+                if pieces and pieces[-1][0] == name:
+                    pieces[-1][1].extend(data)
+                else:
+                    pieces.append((name, bytearray(data)))
+            for name, data in pieces:
+                output_line = decoders[name].decode(bytes(data))
+                if output_line:
+                    await writer.send_stream(name, output_line)
 
         # 4. Após o fim do fluxo, INSPECIONAR a execução
-        inspect_data = docker_client.api.exec_inspect(exec_id)
+        inspect_data = await run_docker(docker_client.api.exec_inspect, exec_id)
         exit_code = inspect_data.get("ExitCode", 0)
 
         # 5. Envia uma mensagem final de "concluído"
         if exit_code == 0:
-            await websocket.send_json({
+            writer.send({
                 "type": "stdout", 
                 "content": f"\n[Execução concluída com código {exit_code}]"
             })
         else:
-            await websocket.send_json({
+            writer.send({
                 "type": "stderr", 
                 "content": f"\n[Execução falhou com código {exit_code}]"
             })
@@ -299,27 +1021,31 @@ async def run_cell_execution(
         # O 'restart_kernel' ou 'stop_execution' cancelou esta tarefa
         print("Execução da célula foi cancelada pelo usuário.")
         try:
-            # Tenta parar a execução no contêiner (melhor esforço)
-            docker_client.api.exec_resize(exec_id, height=0, width=0) # Envia um sinal de interrupção
-        except:
-            pass # Ignora se a execução já terminou
-            
-        await websocket.send_json({
+            if start_future is not None and not start_future.done():
+                output_stream = await start_future
+            # Encerra o processo de fato: assim o stream fecha e a thread que
+            # o lia é liberada, mesmo numa célula que não imprime nada
+            await kill_exec(container, marker)
+        except Exception as e:
+            print(f"Erro ao encerrar a execução da célula: {e}")
+        if output_stream is not None and not streaming:
+            # Stream que ninguém chegou a ler: fecha aqui para liberar a conexão
+            close = getattr(output_stream, "close", None)
+            if close:
+                close()
+        writer.send({
             "type": "stderr", 
             "content": "\n[Execução interrompida pelo usuário]"
         })
     except Exception as e:
         # Um erro inesperado aconteceu na execução
-        await websocket.send_json({
+        writer.send({
             "type": "stderr", 
             "content": f"Erro inesperado no orquestrador: {e}"
         })
     finally:
         # 6. Envia o aviso de filesystem_update (separadamente)
-        await websocket.send_json({
-            "type": "filesystem_update",
-            "content": "Verificando arquivos..."
-        })
+        writer.send_text(FS_UPDATE_MESSAGE)
 
 # --- Endpoints da API HTTP ---
 
@@ -332,9 +1058,8 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
             detail="Usuário ou senha incorretos",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={"sub": user.username}, expires_delta=ACCESS_TOKEN_EXPIRE
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
@@ -346,32 +1071,59 @@ def get_status(current_user: User = Depends(get_current_user)):
 
 @app.get("/v1/notebooks", response_model=List[NotebookInfo])
 async def list_notebooks(current_user: User = Depends(get_current_user)):
-    notebooks = []
-    for f in NOTEBOOK_DIR.glob("*.ipynb"):
-        notebooks.append(NotebookInfo(filename=f.name))
-    return notebooks
+    return await asyncio.to_thread(scan_notebooks)
 
 @app.get("/v1/notebooks/{filename}", response_model=NotebookContent)
 async def get_notebook(filename: str, current_user: User = Depends(get_current_user)):
     safe_path = get_safe_path(filename)
-    if not safe_path.exists():
+    # Notebooks são lidos inteiros de qualquer forma (para validar): uma única
+    # ida à thread, em vez de abrir/ler/fechar cada um com o aiofiles
+    try:
+        content = await asyncio.to_thread(safe_path.read_bytes)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Notebook não encontrado.")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao ler o notebook: {e}")
     try:
-        async with aiofiles.open(safe_path, mode='r', encoding='utf-8') as f:
-            content = await f.read()
-        data = json.loads(content)
-        return data
+        # Só confere a estrutura: os bytes do disco já são o JSON da resposta,
+        # então não passam pelo modelo Pydantic nem são re-serializados.
+        if not is_valid_notebook(orjson.loads(content)):
+            raise ValueError("estrutura do notebook inválida")
+        return Response(content=content, media_type="application/json")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao ler o notebook: {e}")
 
-@app.put("/v1/notebooks/{filename}", status_code=status.HTTP_204_NO_CONTENT)
-async def save_notebook(filename: str, content: NotebookContent, current_user: User = Depends(get_current_user)):
+# O corpo é lido cru (sem Pydantic); o schema só é declarado para a documentação
+@app.put(
+    "/v1/notebooks/{filename}", 
+    status_code=status.HTTP_204_NO_CONTENT,
+    openapi_extra={"requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": NotebookContent.model_json_schema()}}
+    }}
+)
+async def save_notebook(
+    filename: str, 
+    request: Request, 
+    pretty: bool = False, # ?pretty=1 grava indentado, para inspeção manual
+    fsync: bool = False, # ?fsync=1 garante a durabilidade no disco antes de responder
+    current_user: User = Depends(get_current_user)
+):
     safe_path = get_safe_path(filename)
+    # O corpo já é o JSON do notebook: valida a estrutura e grava os bytes
+    # recebidos direto no disco, sem reconstruir o modelo Pydantic.
+    raw = await request.body()
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=422, detail="JSON do notebook inválido.")
+    if not is_valid_notebook(data):
+        raise HTTPException(status_code=422, detail="Estrutura do notebook inválida.")
+    if pretty:
+        raw = orjson.dumps(data, option=orjson.OPT_INDENT_2)
     try:
-        content_dict = content.model_dump()
-        json_content = json.dumps(content_dict, indent=2)
-        async with aiofiles.open(safe_path, mode='w', encoding='utf-8') as f:
-            await f.write(json_content)
+        # O corpo já está todo em memória: grava (atomicamente) numa única ida à thread
+        await asyncio.to_thread(write_file_atomic, safe_path, raw, fsync)
         return Response(status_code=status.HTTP_204_NO_CONTENT)
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao salvar o notebook: {e}")
@@ -402,39 +1154,104 @@ async def rename_notebook(filename: str, request: RenameRequest, current_user: U
         raise HTTPException(status_code=500, detail=f"Erro ao renomear o notebook: {e}")
 
 @app.get("/v1/notebooks/download/{filename}")
-async def download_notebook_file(filename: str, current_user: User = Depends(get_current_user)):
+async def download_notebook_file(filename: str, request: Request, current_user: User = Depends(get_current_user)):
     safe_path = get_safe_path(filename)
-    if not safe_path.exists() or not safe_path.is_file():
-        raise HTTPException(status_code=404, detail="Notebook não encontrado.")
-    return FileResponse(path=safe_path, filename=filename, media_type='application/x-ipynb+json')
+    return file_download_response(
+        request, safe_path, filename, 'application/x-ipynb+json', "Notebook não encontrado."
+    )
 
 @app.get("/v1/files", response_model=List[FileInfo])
 async def list_files_in_workspace(current_user: User = Depends(get_current_user)):
-    files = []
-    for f in WORKSPACE_DIR.glob("*"):
-        if f.is_file():
-            size_kb = round(f.stat().st_size / 1024, 2)
-            files.append(FileInfo(filename=f.name, size_kb=size_kb))
-    return files
-
-@app.post("/v1/files/upload", response_model=FileInfo)
-async def upload_file_to_workspace(file: UploadFile = File(...), current_user: User = Depends(get_current_user)):
-    safe_path = get_safe_workspace_path(file.filename)
+    return await asyncio.to_thread(scan_workspace)
+
+@app.post(
+    "/v1/files/upload",
+    response_model=FileInfo,
+    openapi_extra={"requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "properties": {"file": {"type": "string", "format": "binary"}},
+            "required": ["file"]
+        }}}
+    }}
+)
+async def upload_file_to_workspace(request: Request, current_user: User = Depends(get_current_user)):
+    # O multipart é lido direto do stream (sem o spool temporário do Starlette):
+    # o nome do arquivo é validado assim que o cabeçalho da parte chega, antes
+    # de qualquer byte ir para o disco. Os dados vão para um temporário que só
+    # substitui o destino quando a parte termina: um upload cortado no meio
+    # nunca apaga nem trunca o arquivo que já existia.
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    boundary = params.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise HTTPException(status_code=400, detail="O upload deve ser multipart/form-data.")
+
+    upload = StreamingUploadParser(boundary)
+    filename = None
+    safe_path = None
+    tmp_path = None
+    f = None
+    receiving = False
+    completed = False
+    buffer = bytearray()
+    total = 0
     try:
-        async with aiofiles.open(safe_path, 'wb') as f:
-            while chunk := await file.read(1024 * 1024):
-                await f.write(chunk)
-        size_kb = round(safe_path.stat().st_size / 1024, 2)
-        return FileInfo(filename=file.filename, size_kb=size_kb)
+        async for chunk in request.stream():
+            for kind, value in upload.feed(chunk):
+                if kind == "begin":
+                    field_name, part_filename = value
+                    receiving = field_name == "file" and part_filename is not None and safe_path is None
+                    if receiving:
+                        filename = part_filename
+                        safe_path = get_safe_workspace_path(filename)
+                        tmp_path = temp_path_for(safe_path)
+                        f = await aiofiles.open(tmp_path, 'wb')
+                elif kind == "data" and receiving:
+                    buffer += value
+                    if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                        await f.write(buffer)
+                        total += len(buffer)
+                        buffer.clear()
+                elif kind == "end" and receiving:
+                    await f.write(buffer)
+                    total += len(buffer)
+                    buffer.clear()
+                    await f.close()
+                    f = None
+                    await asyncio.to_thread(os.replace, tmp_path, safe_path)
+                    tmp_path = None
+                    receiving = False
+                    completed = True
+        # O finalize do python-multipart não confere se o boundary final chegou:
+        # uma parte ainda aberta aqui é um corpo truncado
+        upload.finalize()
+        if receiving:
+            raise HTTPException(status_code=400, detail="Upload incompleto: o arquivo não chegou inteiro.")
+    except HTTPException:
+        raise
+    except FormParserError:
+        raise HTTPException(status_code=400, detail="Dados multipart inválidos.")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Erro ao salvar o arquivo: {e}")
+    finally:
+        # Upload interrompido no meio: descarta só o temporário, nunca o destino
+        if f is not None:
+            await f.close()
+        if tmp_path is not None:
+            tmp_path.unlink(missing_ok=True)
+
+    if not completed:
+        raise HTTPException(status_code=400, detail="Nenhum arquivo enviado no campo 'file'.")
+    size_kb = round(total / 1024, 2)
+    return FileInfo(filename=filename, size_kb=size_kb)
 
 @app.get("/v1/files/download/{filename}")
-async def download_file_from_workspace(filename: str, current_user: User = Depends(get_current_user)):
+async def download_file_from_workspace(filename: str, request: Request, current_user: User = Depends(get_current_user)):
     safe_path = get_safe_workspace_path(filename)
-    if not safe_path.exists() or not safe_path.is_file():
-        raise HTTPException(status_code=404, detail="Arquivo não encontrado no workspace.")
-    return FileResponse(path=safe_path, filename=filename, media_type='application/octet-stream')
+    return file_download_response(
+        request, safe_path, filename, 'application/octet-stream', "Arquivo não encontrado no workspace."
+    )
 
 @app.delete("/v1/files/delete/{filename}", status_code=status.HTTP_204_NO_CONTENT)
 async def delete_file_from_workspace(filename: str, current_user: User = Depends(get_current_user)):
@@ -465,11 +1282,11 @@ async def websocket_execute(
     await websocket.accept() 
     
     if not docker_client:
-        await websocket.send_json({"type": "stderr", "content": "Erro Crítico: O servidor não está conectado ao Docker."})
+        await websocket.send_text(NO_DOCKER_MESSAGE)
         await websocket.close()
         return
     if not HOST_WORKSPACE: 
-        await websocket.send_json({"type": "stderr", "content": "Erro Crítico: O servidor não está configurado com HOST_WORKSPACE_PATH."})
+        await websocket.send_text(NO_HOST_WORKSPACE_MESSAGE)
         await websocket.close()
         return
 
@@ -478,154 +1295,128 @@ async def websocket_execute(
     container: docker.models.containers.Container = None
     stats_task: asyncio.Task = None # Referência para a tarefa de stats
     exec_task: asyncio.Task = None # Referência para a tarefa de execução
+    writer = WebSocketWriter(websocket) # Todos os envios da sessão passam por ele
 
     try:
         # 2. Encontrar ou Criar o Kernel
-        if kernel_id in kernel_sessions:
-            container = kernel_sessions[kernel_id]
-            print(f"Reconectando ao kernel para o usuário: {kernel_id}")
-            container.reload() 
-            if container.status != "running":
-                raise Exception("O kernel foi parado inesperadamente.")
-        else:
-            # Primeiro login, precisamos criar um novo kernel
-            print(f"Criando novo kernel para o usuário: {kernel_id}...")
-            
-            volumes_to_mount = {}
-            working_dir_path = "/"
-            if HOST_WORKSPACE:
-                host_path_str = str(HOST_WORKSPACE).replace("\\", "/")
-                if host_path_str.startswith("C:"):
-                    host_path_str = "/" + host_path_str[0].lower() + host_path_str[2:]
-                volumes_to_mount[host_path_str] = { 'bind': '/data', 'mode': 'rw' }
-                working_dir_path = "/data/Uploads"
-            
-            common_config = {
-                "image": "python:3.11-slim",
-                "command": ["sleep", "infinity"], 
-                "detach": True, 
-                "mem_limit": "12g", # Limite de 8GB de RAM
-                "volumes": volumes_to_mount,
-                "working_dir": working_dir_path,
-                "auto_remove": True,
-            }
+        # Conexões simultâneas do mesmo usuário (ex: duas abas) esperam aqui,
+        # para a segunda reaproveitar o kernel em vez de criar outro
+        kernel_lock = kernel_locks.setdefault(kernel_id, asyncio.Lock())
+        async with kernel_lock:
+            if kernel_id in kernel_sessions:
+                container, last_checked = kernel_sessions[kernel_id]
+                print(f"Reconectando ao kernel para o usuário: {kernel_id}")
+                now = time.monotonic()
+                if now - last_checked > KERNEL_RECHECK_SECONDS:
+                    # Só o estado interessa: inspect direto, sem reidratar o modelo (reload)
+                    inspect_data = await run_docker(docker_client.api.inspect_container, container.id)
+                    if inspect_data["State"]["Status"] != "running":
+                        raise Exception("O kernel foi parado inesperadamente.")
+                    kernel_sessions[kernel_id] = (container, now)
+            else:
+                # Primeiro login, precisamos criar um novo kernel
+                print(f"Alocando kernel para o usuário: {kernel_id}...")
+                container = await acquire_kernel()
             
-            gpu_config = {
-                "device_requests": [
-                    DeviceRequest(count=-1, capabilities=[['gpu']])
-                ]
-            }
-
-            container = None
-            try:
-                # TENTATIVA 1: Alocar com GPU
-                print(f"Tentando alocar kernel com GPU para {kernel_id}...")
-                container = docker_client.containers.run(
-                    **common_config,
-                    **gpu_config
-                )
-                print(f"Kernel {container.short_id} criado com SUCESSO (com GPU).")
-            except docker.errors.APIError as e:
-                if "could not select device driver" in str(e):
-                    # TENTATIVA 2: Alocar com CPU Apenas
-                    print(f"Falha ao alocar GPU (NVIDIA Toolkit ausente?). Erro: {e}")
-                    print(f"Tentando alocar kernel em modo fallback (somente CPU) para {kernel_id}...")
-                    container = docker_client.containers.run(
-                        **common_config
-                    )
-                    print(f"Kernel {container.short_id} criado com SUCESSO (somente CPU).")
-                else:
-                    raise e
-            
-            kernel_sessions[kernel_id] = container
-            await websocket.send_json({"type": "stdout", "content": "Kernel conectado e pronto."})
+                kernel_sessions[kernel_id] = (container, time.monotonic())
+                writer.send({"type": "stdout", "content": "Kernel conectado e pronto."})
 
         # --- Inicia as tarefas de monitoramento (Sprint 14) ---
         
         # 1. Envia os stats de DISCO (uma vez)
-        await get_disk_stats(websocket, container)
+        await get_disk_stats(writer)
         
-        # 2. Inicia o streaming de RAM/CPU (em segundo plano)
-        stats_task = asyncio.create_task(
-            stream_resource_stats(websocket, container)
-        )
-
-        # 3. Loop de Execução (escuta por código)
-        while True:
-            data = await websocket.receive_json()
+        # 2. Tarefas da sessão num TaskGroup: ao sair (desconexão, erro ou
+        # reinício) todas são canceladas E aguardadas, então nenhum stream do
+        # Docker fica aberto depois que o kernel é destruído
+        async with asyncio.TaskGroup() as session_tasks:
+            # Streaming de RAM/CPU (em segundo plano)
+            stats_task = session_tasks.create_task(
+                stream_resource_stats(writer, container)
+            )
+            try:
+                # 3. Loop de Execução (escuta por código)
+                while True:
+                    data = await websocket.receive_json()
             
-            action = data.get("action")
-            is_running = exec_task and not exec_task.done()
-
-            if action == "execute":
-                if is_running:
-                    await websocket.send_json({
-                        "type": "stderr", 
-                        "content": "\n[Ignorado: Uma célula já está em execução]"
-                    })
-                    continue
+                    action = data.get("action")
+                    is_running = exec_task and not exec_task.done()
+
+                    if action == "execute":
+                        if is_running:
+                            writer.send({
+                                "type": "stderr", 
+                                "content": "\n[Ignorado: Uma célula já está em execução]"
+                            })
+                            continue
                 
-                code = data.get("code")
-                if code is None:
-                    continue
+                        code = data.get("code")
+                        if code is None:
+                            continue
                 
-                # Lança a execução como uma tarefa de segundo plano
-                exec_task = asyncio.create_task(
-                    run_cell_execution(websocket, container, code)
-                )
-
-            # Ação "Parar"
-            elif action == "stop_execution":
-                print(f"Recebida solicitação de PARAR para {kernel_id}...")
-                if is_running:
-                    print("Cancelando execução de célula em progresso...")
-                    exec_task.cancel()
-                else:
-                    print("Nenhuma execução para parar.")
-                    # Envia uma mensagem de volta para o frontend
-                    # para garantir que o loader seja desligado
-                    await websocket.send_json({
-                        "type": "stdout", 
-                        "content": "\n[Nenhuma execução para parar]"
-                    })
-
-            elif action == "restart_kernel":
-                print(f"Recebida solicitação de reinício de kernel para {kernel_id}...")
+                        # Lança a execução como uma tarefa de segundo plano
+                        exec_task = session_tasks.create_task(
+                            run_cell_execution(writer, container, code)
+                        )
+
+                    # Ação "Parar"
+                    elif action == "stop_execution":
+                        print(f"Recebida solicitação de PARAR para {kernel_id}...")
+                        if is_running:
+                            print("Cancelando execução de célula em progresso...")
+                            exec_task.cancel()
+                        else:
+                            print("Nenhuma execução para parar.")
+                            # Envia uma mensagem de volta para o frontend
+                            # para garantir que o loader seja desligado
+                            writer.send({
+                                "type": "stdout", 
+                                "content": "\n[Nenhuma execução para parar]"
+                            })
+
+                    elif action == "restart_kernel":
+                        print(f"Recebida solicitação de reinício de kernel para {kernel_id}...")
                 
-                if is_running:
-                    # Cancela a tarefa de execução em progresso
-                    print("Cancelando execução de célula em progresso...")
-                    exec_task.cancel()
+                        if is_running:
+                            # Cancela a tarefa de execução em progresso
+                            print("Cancelando execução de célula em progresso...")
+                            exec_task.cancel()
                 
-                await websocket.send_json({
-                    "type": "status", 
-                    "content": "Reiniciando kernel..."
-                })
+                        writer.send({
+                            "type": "status", 
+                            "content": "Reiniciando kernel..."
+                        })
                 
-                # Fecha a conexão para acionar o 'finally' e matar o contêiner
-                await websocket.close(code=1000, reason="Kernel restarting")
-                break # Sai do loop 'while True'
+                        # Fecha a conexão para acionar o 'finally' e matar o contêiner
+                        await writer.flush()
+                        await websocket.close(code=1000, reason="Kernel restarting")
+                        break # Sai do loop 'while True'
+            finally:
+                # Stats (e uma célula em andamento) não terminam sozinhos:
+                # cancela antes de o TaskGroup esperar por eles
+                stats_task.cancel()
+                if exec_task:
+                    exec_task.cancel()
 
-    except WebSocketDisconnect:
+    # O TaskGroup embrulha as exceções do corpo num ExceptionGroup
+    except* WebSocketDisconnect:
         print(f"Cliente WebSocket desconectado: {kernel_id}")
-    except Exception as e:
+    except* Exception as error_group:
+        e = error_group.exceptions[0]
         print(f"Erro no WebSocket ou Kernel: {e}")
         try:
             await websocket.close(code=1011, reason=f"Erro: {e}")
         except:
             pass 
     finally:
-        # 10. Limpeza (Destruir o Kernel e Tarefas)
-        if stats_task:
-            stats_task.cancel()
-        if exec_task: 
-            exec_task.cancel()
+        # 10. Limpeza (Destruir o Kernel; as tarefas já foram encerradas pelo TaskGroup)
+        writer.close()
         
         if kernel_id in kernel_sessions:
-            container_to_remove = kernel_sessions.pop(kernel_id)
+            container_to_remove, _ = kernel_sessions.pop(kernel_id)
             try:
                 print(f"Destruindo kernel {container_to_remove.short_id} para {kernel_id}...")
-                container_to_remove.remove(force=True)
+                await run_docker(container_to_remove.remove, force=True)
                 print(f"Kernel {container_to_remove.short_id} destruído.")
             except docker.errors.NotFound:
                 print("Kernel já havia sido removido.")